@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, render_template_string, send_file
+from flask import Flask, request, jsonify, render_template_string, send_file, g
 from flask_cors import CORS
 from datetime import datetime, timedelta
 import json
@@ -9,6 +9,17 @@ from contextlib import contextmanager
 import logging
 import base64
 import io
+import sys
+import threading
+import time
+import math
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -21,6 +32,55 @@ CORS(app)
 DATABASE = 'transport_feedback.db'
 UPLOAD_FOLDER = 'uploads'
 
+# Read-replica snapshot for analytics queries
+READ_REPLICA = os.environ.get('READ_REPLICA', '').lower() in ('1', 'true', 'yes')
+REPLICA_DATABASE = os.environ.get('REPLICA_DATABASE', 'transport_feedback_replica.db')
+REPLICA_REFRESH_SECONDS = int(os.environ.get('REPLICA_REFRESH_SECONDS', 30))
+REPLICA_MAX_STALENESS = int(os.environ.get('REPLICA_MAX_STALENESS', 120))
+
+# Tables read by the analytics endpoints, and blob columns left out of the snapshot
+REPLICA_TABLES = ('feedback', 'ticket_files', 'ticket_variants', 'ticket_processing',
+                  'route_rollups', 'route_problem_rollups')
+REPLICA_BLOB_COLUMNS = {
+    'ticket_files': ('file_data',),
+    'ticket_variants': ('file_data',)
+}
+
+_replica_lock = threading.Lock()
+_replica_start_lock = threading.Lock()
+_replica_thread = None
+
+# Ticket image pipeline configuration
+# Per web worker: gunicorn runs one pool in each of its worker processes
+TICKET_WORKERS = int(os.environ.get('TICKET_WORKERS', 2))
+BACKFILL_WORKERS = int(os.environ.get('BACKFILL_WORKERS', os.cpu_count() or 1))
+THUMBNAIL_SIZE = (320, 320)
+THUMBNAIL_QUALITY = 75
+RECOMPRESS_QUALITY = 85
+IMAGE_FORMATS = {
+    'image/jpeg': 'JPEG',
+    'image/jpg': 'JPEG',
+    'image/png': 'PNG',
+    'image/webp': 'WEBP'
+}
+
+_image_executor = None
+_image_executor_lock = threading.Lock()
+
+# Route analytics rollups
+ROLLUP_BUCKETS = ('hour', 'day', 'week')
+DEFAULT_RANGES = {
+    'hour': timedelta(hours=48),
+    'day': timedelta(days=30),
+    'week': timedelta(weeks=12)
+}
+BUCKET_STEPS = {
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+    'week': timedelta(weeks=1)
+}
+RATING_PERCENTILES = (25, 50, 75, 90)
+
 # Ensure upload folder exists
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
@@ -82,6 +142,71 @@ def init_db():
             )
         ''')
         
+        # Precomputed ticket image variants (thumbnails)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ticket_variants (
+                ticket_file_id TEXT NOT NULL,
+                variant TEXT NOT NULL,
+                file_type TEXT NOT NULL,
+                file_size INTEGER NOT NULL,
+                file_data BLOB NOT NULL,
+                created_time TEXT NOT NULL,
+                PRIMARY KEY (ticket_file_id, variant),
+                FOREIGN KEY (ticket_file_id) REFERENCES ticket_files (id)
+            )
+        ''')
+        
+        # Image processing results, one row per processed ticket file
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ticket_processing (
+                ticket_file_id TEXT PRIMARY KEY,
+                original_size INTEGER NOT NULL,
+                compressed_size INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                processed_time TEXT NOT NULL,
+                FOREIGN KEY (ticket_file_id) REFERENCES ticket_files (id)
+            )
+        ''')
+        
+        # Per-route counts and rating histograms at hour/day/week granularity
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS route_rollups (
+                bucket TEXT NOT NULL,
+                bucket_start TEXT NOT NULL,
+                route TEXT NOT NULL,
+                transport_type TEXT NOT NULL,
+                feedback_count INTEGER DEFAULT 0,
+                rating_sum INTEGER DEFAULT 0,
+                complaint_count INTEGER DEFAULT 0,
+                complaint_rating_sum INTEGER DEFAULT 0,
+                rating_1 INTEGER DEFAULT 0,
+                rating_2 INTEGER DEFAULT 0,
+                rating_3 INTEGER DEFAULT 0,
+                rating_4 INTEGER DEFAULT 0,
+                rating_5 INTEGER DEFAULT 0,
+                PRIMARY KEY (bucket, bucket_start, route, transport_type)
+            )
+        ''')
+        
+        # Per-route problem counts at the same granularities
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS route_problem_rollups (
+                bucket TEXT NOT NULL,
+                bucket_start TEXT NOT NULL,
+                route TEXT NOT NULL,
+                transport_type TEXT NOT NULL,
+                problem TEXT NOT NULL,
+                problem_count INTEGER DEFAULT 0,
+                complaint_count INTEGER DEFAULT 0,
+                PRIMARY KEY (bucket, bucket_start, route, transport_type, problem)
+            )
+        ''')
+        
+        # Build rollups for feedback submitted before they existed
+        cursor.execute('SELECT COUNT(*) FROM route_rollups')
+        if cursor.fetchone()[0] == 0:
+            rebuild_route_rollups(cursor)
+        
         # Insert sample hotspot data for demonstration
         sample_hotspots = [
             ('pune_station', 'Pune Railway Station', 'train', 18.5284, 73.8741, 15, 2.3),
@@ -114,6 +239,309 @@ def get_db():
     finally:
         conn.close()
 
+def refresh_replica():
+    """Copy the tables the analytics endpoints read into the replica file"""
+    # Skip if this process is already refreshing
+    if not _replica_lock.acquire(blocking=False):
+        return False
+    
+    tmp_path = f'{REPLICA_DATABASE}.{os.getpid()}.tmp'
+    try:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        
+        started = time.time()
+        # uri=True so the ATTACH below is parsed as a URI on every SQLite build
+        target = sqlite3.connect(f'file:{tmp_path}', uri=True, isolation_level=None)
+        try:
+            target.execute('ATTACH DATABASE ? AS src', (f'file:{DATABASE}?mode=ro',))
+            # One read transaction so every table comes from the same point in time
+            target.execute('BEGIN')
+            for table in REPLICA_TABLES:
+                schema = target.execute(
+                    "SELECT sql FROM src.sqlite_master WHERE type = 'table' AND name = ?", (table,)
+                ).fetchone()
+                if not schema:
+                    # Never swap in a snapshot the analytics endpoints cannot query
+                    raise sqlite3.OperationalError(f'Primary database has no table {table}')
+                target.execute(schema[0])
+                
+                # Image blobs are not needed for analytics; store them empty
+                columns = [row[1] for row in target.execute(f'PRAGMA src.table_info({table})')]
+                blob_columns = REPLICA_BLOB_COLUMNS.get(table, ())
+                select = ', '.join("X''" if c in blob_columns else c for c in columns)
+                target.execute(f'INSERT INTO main.{table} SELECT {select} FROM src.{table}')
+            target.execute('COMMIT')
+            target.execute('DETACH DATABASE src')
+        finally:
+            target.close()
+        
+        # Stamp the snapshot with the time it was taken, then swap it in atomically
+        os.utime(tmp_path, (started, started))
+        os.replace(tmp_path, REPLICA_DATABASE)
+        return True
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        _replica_lock.release()
+
+def replica_staleness():
+    """Seconds since the replica snapshot was taken, or None if there is none"""
+    try:
+        return max(0.0, time.time() - os.path.getmtime(REPLICA_DATABASE))
+    except OSError:
+        return None
+
+def _replica_refresher():
+    """Background loop keeping the replica snapshot fresh"""
+    wal_enabled = False
+    while True:
+        try:
+            # Persistent switch on the primary: in WAL mode the snapshot read does
+            # not block feedback writes. Done once, off the request path.
+            if not wal_enabled:
+                with sqlite3.connect(DATABASE) as conn:
+                    conn.execute('PRAGMA journal_mode=WAL')
+                wal_enabled = True
+            
+            staleness = replica_staleness()
+            if staleness is None or staleness >= REPLICA_REFRESH_SECONDS:
+                refresh_replica()
+        except Exception as e:
+            logger.error(f"Error refreshing read replica: {e}")
+        time.sleep(REPLICA_REFRESH_SECONDS)
+
+def start_replica_refresher():
+    """Start the replica refresh thread once per process"""
+    global _replica_thread
+    if not READ_REPLICA or (_replica_thread and _replica_thread.is_alive()):
+        return
+    
+    with _replica_start_lock:
+        # Re-check: concurrent first requests may race to get here
+        if _replica_thread and _replica_thread.is_alive():
+            return
+        _replica_thread = threading.Thread(target=_replica_refresher, daemon=True)
+        _replica_thread.start()
+    logger.info(f"Read replica enabled: {REPLICA_DATABASE} (refresh {REPLICA_REFRESH_SECONDS}s)")
+
+@contextmanager
+def get_read_db():
+    """Get a connection for analytical reads, served from the replica when it is fresh enough"""
+    staleness = None
+    if READ_REPLICA:
+        start_replica_refresher()
+        staleness = replica_staleness()
+        if staleness is not None and staleness > REPLICA_MAX_STALENESS:
+            staleness = None
+    
+    if staleness is None:
+        # No usable snapshot: read the primary
+        conn = sqlite3.connect(DATABASE)
+        g.data_source, g.data_staleness = 'primary', 0.0
+    else:
+        conn = sqlite3.connect(f'file:{REPLICA_DATABASE}?mode=ro', uri=True)
+        g.data_source, g.data_staleness = 'replica', staleness
+    
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+@app.after_request
+def add_staleness_headers(response):
+    """Report where analytical data came from and how old it is"""
+    if 'data_source' in g:
+        response.headers['X-Data-Source'] = g.data_source
+        response.headers['X-Data-Staleness'] = f'{g.data_staleness:.1f}'
+    return response
+
+def truncate_to_bucket(dt, bucket):
+    """Truncate a datetime to the start of its hour, day or (Monday-based) week"""
+    if bucket == 'hour':
+        return dt.replace(minute=0, second=0, microsecond=0)
+    start = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    if bucket == 'week':
+        start -= timedelta(days=start.weekday())
+    return start
+
+def bucket_start(dt, bucket):
+    """Rollup key for the bucket containing a datetime"""
+    return truncate_to_bucket(dt, bucket).strftime('%Y-%m-%dT%H:%M:%S')
+
+def is_bucket_aligned(dt, bucket):
+    """True if a range bound (or an open bound) falls on a bucket boundary"""
+    return dt is None or truncate_to_bucket(dt, bucket) == dt
+
+def next_bucket_boundary(dt, bucket):
+    """First bucket boundary at or after a datetime"""
+    start = truncate_to_bucket(dt, bucket)
+    return dt if start == dt else start + BUCKET_STEPS[bucket]
+
+def update_route_rollups(cursor, timestamp, route, transport_type, rating, problems):
+    """Add one feedback entry to the route rollups (caller commits)"""
+    dt = datetime.fromisoformat(timestamp)
+    complaint = 1 if rating <= 3 else 0
+    rating_column = f'rating_{min(max(rating, 1), 5)}'
+    problem_list = set(p for p in problems.split(',') if p) if problems else set()
+    
+    for bucket in ROLLUP_BUCKETS:
+        start = bucket_start(dt, bucket)
+        cursor.execute(f'''
+            INSERT INTO route_rollups 
+            (bucket, bucket_start, route, transport_type, feedback_count, rating_sum,
+             complaint_count, complaint_rating_sum, {rating_column})
+            VALUES (?, ?, ?, ?, 1, ?, ?, ?, 1)
+            ON CONFLICT (bucket, bucket_start, route, transport_type) DO UPDATE SET
+                feedback_count = feedback_count + 1,
+                rating_sum = rating_sum + excluded.rating_sum,
+                complaint_count = complaint_count + excluded.complaint_count,
+                complaint_rating_sum = complaint_rating_sum + excluded.complaint_rating_sum,
+                {rating_column} = {rating_column} + 1
+        ''', (bucket, start, route, transport_type, rating, complaint, rating * complaint))
+        
+        for problem in problem_list:
+            cursor.execute('''
+                INSERT INTO route_problem_rollups 
+                (bucket, bucket_start, route, transport_type, problem, problem_count, complaint_count)
+                VALUES (?, ?, ?, ?, ?, 1, ?)
+                ON CONFLICT (bucket, bucket_start, route, transport_type, problem) DO UPDATE SET
+                    problem_count = problem_count + 1,
+                    complaint_count = complaint_count + excluded.complaint_count
+            ''', (bucket, start, route, transport_type, problem, complaint))
+
+def rebuild_route_rollups(cursor):
+    """Recompute all route rollups from the feedback table (caller commits)"""
+    cursor.execute('DELETE FROM route_rollups')
+    cursor.execute('DELETE FROM route_problem_rollups')
+    cursor.execute('SELECT timestamp, route, transport_type, rating, problems FROM feedback')
+    rows = cursor.fetchall()
+    for row in rows:
+        update_route_rollups(cursor, *row)
+    logger.info(f"Route rollups rebuilt from {len(rows)} feedback entries")
+
+def rating_percentiles(histogram):
+    """Nearest-rank rating percentiles from a 1-5 rating histogram"""
+    total = sum(histogram)
+    result = {}
+    for q in RATING_PERCENTILES:
+        if not total:
+            result[f'p{q}'] = None
+            continue
+        rank = max(1, math.ceil(q / 100 * total))
+        cumulative = 0
+        for rating, count in enumerate(histogram, start=1):
+            cumulative += count
+            if cumulative >= rank:
+                result[f'p{q}'] = rating
+                break
+    return result
+
+def parse_hours(value):
+    """Parse an hour-of-day window like '8-10' into (8, 10), end exclusive"""
+    try:
+        start, end = (int(part) for part in value.split('-'))
+    except ValueError:
+        raise ValueError(f"Invalid hours: {value} (expected a window like '8-10')")
+    if not 0 <= start < end <= 24:
+        raise ValueError(f'Invalid hours: {value} (must satisfy 0 <= start < end <= 24)')
+    return start, end
+
+def rollup_source(preferred, range_from, range_to):
+    """Coarsest rollup, no coarser than `preferred`, whose buckets fit exactly inside the range"""
+    for bucket in reversed(ROLLUP_BUCKETS[:ROLLUP_BUCKETS.index(preferred) + 1]):
+        if is_bucket_aligned(range_from, bucket) and is_bucket_aligned(range_to, bucket):
+            return bucket
+    raise ValueError('from and to must fall on an hour boundary')
+
+def rollup_filters(granularity, start, end, hours=None, route=None, transport_type=None):
+    """WHERE clause and params for rollup rows in [start, end) at one granularity"""
+    clause = 'bucket = ?'
+    params = [granularity]
+    if start:
+        clause += ' AND bucket_start >= ?'
+        params.append(bucket_start(start, granularity))
+    if end:
+        clause += ' AND bucket_start < ?'
+        params.append(bucket_start(end, granularity))
+    if hours:
+        clause += ' AND CAST(substr(bucket_start, 12, 2) AS INTEGER) >= ?'
+        clause += ' AND CAST(substr(bucket_start, 12, 2) AS INTEGER) < ?'
+        params.extend(hours)
+    if route:
+        clause += ' AND route = ?'
+        params.append(route)
+    if transport_type:
+        clause += ' AND transport_type = ?'
+        params.append(transport_type)
+    return clause, params
+
+def fetch_route_rollups(cursor, granularity, start, end, **filters):
+    """Rollup rows for a range, oldest first"""
+    clause, params = rollup_filters(granularity, start, end, **filters)
+    cursor.execute(f'''
+        SELECT * FROM route_rollups
+        WHERE {clause}
+        ORDER BY bucket_start
+    ''', params)
+    return cursor.fetchall()
+
+def fetch_route_problems(cursor, granularity, start, end, **filters):
+    """Problem counts for a range, keyed by (route, transport_type)"""
+    clause, params = rollup_filters(granularity, start, end, **filters)
+    cursor.execute(f'''
+        SELECT route, transport_type, problem,
+               SUM(problem_count) as problem_count,
+               SUM(complaint_count) as complaint_count
+        FROM route_problem_rollups
+        WHERE {clause}
+        GROUP BY route, transport_type, problem
+    ''', params)
+    problems = {}
+    for row in cursor.fetchall():
+        problems.setdefault((row['route'], row['transport_type']), []).append(dict(row))
+    return problems
+
+def top_route_problems(problems, field):
+    """Names of the three most frequent problems by the given count field"""
+    ranked = sorted((p for p in problems if p[field]), key=lambda p: (-p[field], p['problem']))
+    return [p['problem'] for p in ranked[:3]]
+
+def empty_rollup_totals():
+    """Accumulator for summed rollup rows"""
+    return {'feedback_count': 0, 'rating_sum': 0, 'complaint_count': 0,
+            'complaint_rating_sum': 0, 'histogram': [0] * 5}
+
+def add_rollup_row(totals, row):
+    """Add one rollup row into an accumulator"""
+    for field in ('feedback_count', 'rating_sum', 'complaint_count', 'complaint_rating_sum'):
+        totals[field] += row[field]
+    for rating in range(1, 6):
+        totals['histogram'][rating - 1] += row[f'rating_{rating}']
+
+def describe_rollup_totals(totals):
+    """Counts, average rating and percentiles for an accumulator"""
+    count = totals['feedback_count']
+    return {
+        'feedback_count': count,
+        'avg_rating': round(totals['rating_sum'] / count, 2) if count else None,
+        'complaint_count': totals['complaint_count'],
+        'percentiles': rating_percentiles(totals['histogram'])
+    }
+
+def week_over_week(this_week, last_week):
+    """Compare two described 7-day windows"""
+    avg_delta = None
+    if this_week['avg_rating'] is not None and last_week['avg_rating'] is not None:
+        avg_delta = round(this_week['avg_rating'] - last_week['avg_rating'], 2)
+    return {
+        'this_week': this_week,
+        'last_week': last_week,
+        'feedback_count_delta': this_week['feedback_count'] - last_week['feedback_count'],
+        'avg_rating_delta': avg_delta
+    }
+
 def determine_priority(rating, problems):
     """Determine priority based on rating and problems"""
     problem_list = problems.split(',') if problems else []
@@ -159,12 +587,220 @@ def save_ticket_file(feedback_id, ticket_data):
             ))
             conn.commit()
         
+        # Thumbnail and recompress in the background
+        schedule_ticket_processing(file_id, ticket_data['type'], file_data)
+        
         return file_id
     
     except Exception as e:
         logger.error(f"Error saving ticket file: {e}")
         return None
 
+def process_ticket_image(file_data, file_type):
+    """Build thumbnails and an EXIF-free recompressed original (runs in a worker process)"""
+    image = Image.open(io.BytesIO(file_data))
+    had_exif = bool(image.info.get('exif')) or bool(image.getexif())
+    
+    # Apply EXIF orientation before the metadata is dropped
+    image = ImageOps.exif_transpose(image)
+    
+    def encode(img, fmt, **options):
+        buffer = io.BytesIO()
+        img.save(buffer, format=fmt, **options)
+        return buffer.getvalue()
+    
+    # Recompress the original in its own format; saving without exif= strips metadata
+    fmt = IMAGE_FORMATS[file_type]
+    if fmt == 'JPEG':
+        original = image.convert('RGB') if image.mode not in ('RGB', 'L') else image
+        compressed = encode(original, 'JPEG', quality=RECOMPRESS_QUALITY,
+                            optimize=True, progressive=True)
+    elif fmt == 'PNG':
+        compressed = encode(image, 'PNG', optimize=True)
+    else:
+        compressed = encode(image, 'WEBP', quality=RECOMPRESS_QUALITY, method=6)
+    
+    # Keep the original bytes unless recompression helped or metadata had to go
+    if len(compressed) >= len(file_data) and not had_exif:
+        compressed = None
+    
+    thumb = image.copy()
+    thumb.thumbnail(THUMBNAIL_SIZE)
+    
+    # Flatten transparency onto white; a bare convert('RGB') turns it black
+    if thumb.mode in ('RGBA', 'LA') or (thumb.mode == 'P' and 'transparency' in thumb.info):
+        thumb = thumb.convert('RGBA')
+        thumb_rgb = Image.new('RGB', thumb.size, (255, 255, 255))
+        thumb_rgb.paste(thumb, mask=thumb.getchannel('A'))
+    else:
+        thumb_rgb = thumb.convert('RGB')
+    
+    return {
+        'compressed': compressed,
+        'thumbs': {
+            'thumb_webp': ('image/webp', encode(thumb_rgb, 'WEBP', quality=THUMBNAIL_QUALITY, method=6)),
+            'thumb_jpeg': ('image/jpeg', encode(thumb_rgb, 'JPEG', quality=THUMBNAIL_QUALITY, optimize=True))
+        }
+    }
+
+def _process_ticket_job(file_id, file_type, file_data):
+    """Worker entry point that never raises, so one bad upload cannot break a batch"""
+    try:
+        return file_id, len(file_data), process_ticket_image(file_data, file_type), None
+    except Exception as e:
+        return file_id, len(file_data), None, str(e)
+
+def store_ticket_processing(file_id, original_size, result, error=None):
+    """Persist thumbnails and the recompressed original produced by a worker"""
+    now = datetime.now().isoformat()
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        
+        if error:
+            logger.error(f"Error processing ticket image {file_id}: {error}")
+            cursor.execute('''
+                INSERT OR REPLACE INTO ticket_processing 
+                (ticket_file_id, original_size, compressed_size, status, processed_time)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (file_id, original_size, original_size, 'failed', now))
+            conn.commit()
+            return
+        
+        for variant, (variant_type, variant_data) in result['thumbs'].items():
+            cursor.execute('''
+                INSERT OR REPLACE INTO ticket_variants 
+                (ticket_file_id, variant, file_type, file_size, file_data, created_time)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (file_id, variant, variant_type, len(variant_data), variant_data, now))
+        
+        compressed_size = original_size
+        if result['compressed'] is not None:
+            compressed_size = len(result['compressed'])
+            cursor.execute('''
+                UPDATE ticket_files 
+                SET file_data = ?, file_size = ?
+                WHERE id = ?
+            ''', (result['compressed'], compressed_size, file_id))
+        
+        cursor.execute('''
+            INSERT OR REPLACE INTO ticket_processing 
+            (ticket_file_id, original_size, compressed_size, status, processed_time)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (file_id, original_size, compressed_size, 'done', now))
+        conn.commit()
+    
+    logger.info(f"Ticket image processed: {file_id} ({original_size} -> {compressed_size} bytes)")
+
+def get_image_executor():
+    """Lazily create the shared worker pool for ticket image processing"""
+    global _image_executor
+    if _image_executor is None:
+        with _image_executor_lock:
+            # Re-check: a concurrent upload may have created it meanwhile
+            if _image_executor is None:
+                _image_executor = ProcessPoolExecutor(max_workers=TICKET_WORKERS)
+    return _image_executor
+
+def reset_image_executor(executor):
+    """Drop a broken worker pool so the next upload starts a fresh one"""
+    global _image_executor
+    with _image_executor_lock:
+        if _image_executor is not executor:
+            return
+        _image_executor = None
+    executor.shutdown(wait=False)
+    logger.warning("Ticket image worker pool broke; it will be recreated")
+
+def schedule_ticket_processing(file_id, file_type, file_data):
+    """Queue a freshly uploaded ticket for background thumbnailing"""
+    if Image is None or file_type not in IMAGE_FORMATS:
+        return
+    
+    executor = get_image_executor()
+    
+    def on_done(future):
+        try:
+            store_ticket_processing(*future.result())
+        except BrokenProcessPool:
+            # e.g. a worker was OOM-killed; the backfill picks this ticket up later
+            logger.error(f"Worker pool broke while processing ticket {file_id}")
+            reset_image_executor(executor)
+        except Exception as e:
+            logger.error(f"Error storing processed ticket {file_id}: {e}")
+    
+    try:
+        future = executor.submit(_process_ticket_job, file_id, file_type, file_data)
+        future.add_done_callback(on_done)
+    except BrokenProcessPool:
+        reset_image_executor(executor)
+        logger.error(f"Worker pool broken; ticket {file_id} left for backfill")
+    except Exception as e:
+        logger.error(f"Error scheduling ticket processing: {e}")
+
+def backfill_ticket_images(batch_size=None):
+    """Process every unprocessed ticket image in parallel across all cores"""
+    if Image is None:
+        logger.error("Pillow is not installed; cannot backfill ticket images")
+        return 0
+    
+    batch_size = batch_size or BACKFILL_WORKERS * 4
+    placeholders = ','.join('?' * len(IMAGE_FORMATS))
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT tf.id, tf.file_type
+            FROM ticket_files tf
+            LEFT JOIN ticket_processing tp ON tp.ticket_file_id = tf.id
+            WHERE tp.ticket_file_id IS NULL AND tf.file_type IN ({placeholders})
+        ''', list(IMAGE_FORMATS))
+        pending = [(row['id'], row['file_type']) for row in cursor.fetchall()]
+    
+    processed = 0
+    skipped = 0
+    executor = ProcessPoolExecutor(max_workers=BACKFILL_WORKERS)
+    try:
+        # Load blobs one batch at a time so the whole table is never held in memory
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            with get_db() as conn:
+                cursor = conn.cursor()
+                jobs = []
+                for file_id, file_type in batch:
+                    cursor.execute('SELECT file_data FROM ticket_files WHERE id = ?', (file_id,))
+                    row = cursor.fetchone()
+                    if row:
+                        jobs.append((file_id, file_type, row['file_data']))
+            
+            broken = False
+            try:
+                futures = [executor.submit(_process_ticket_job, *job) for job in jobs]
+            except BrokenProcessPool:
+                futures, broken = [], True
+                skipped += len(jobs)
+            
+            for future in futures:
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    # e.g. a worker was OOM-killed; the ticket stays pending for the next run
+                    broken = True
+                    skipped += 1
+                    continue
+                store_ticket_processing(*result)
+                processed += 1
+            
+            if broken:
+                logger.error("Backfill worker pool broke; recreating it and continuing")
+                executor.shutdown(wait=False)
+                executor = ProcessPoolExecutor(max_workers=BACKFILL_WORKERS)
+    finally:
+        executor.shutdown()
+    
+    logger.info(f"Ticket image backfill completed: {processed} files, {skipped} left pending")
+    return processed
+
 @app.route('/')
 def index():
     """Serve a simple API status page"""
@@ -218,12 +854,12 @@ def index():
             
             <div class="endpoint">
                 <span class="method">GET</span> <strong>/api/ticket/{feedback_id}</strong>
-                <p>Download/view uploaded ticket file</p>
+                <p>Download/view uploaded ticket file (?size=thumb for a preview)</p>
             </div>
             
             <div class="endpoint">
                 <span class="method">GET</span> <strong>/api/analytics/routes</strong>
-                <p>Get analytics for problematic routes</p>
+                <p>Get analytics for problematic routes (optional from, to, bucket=hour|day|week, hours=8-10, route, transport_type)</p>
             </div>
             
             <div class="endpoint">
@@ -261,6 +897,7 @@ def submit_feedback():
             ticket_file_id = save_ticket_file(feedback_id, data['ticketData'])
         
         # Insert into database
+        timestamp = datetime.now().isoformat()
         with get_db() as conn:
             cursor = conn.cursor()
             cursor.execute('''
@@ -271,7 +908,7 @@ def submit_feedback():
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (
                 feedback_id,
-                datetime.now().isoformat(),
+                timestamp,
                 data['transportType'],
                 data['route'],
                 data['journey'],
@@ -289,6 +926,10 @@ def submit_feedback():
                 data.get('ticketData', {}).get('type') if data.get('ticketData') else None,
                 data.get('ticketData', {}).get('size') if data.get('ticketData') else None
             ))
+            
+            # Keep analytics rollups in step with the feedback table
+            update_route_rollups(cursor, timestamp, data['route'], data['transportType'],
+                                 int(data['rating']), problems)
             conn.commit()
         
         # Update route hotspot data if location provided
@@ -349,6 +990,7 @@ def get_feedback():
             # Add ticket URL if ticket exists
             if item['has_ticket'] and item['ticket_path']:
                 item['ticket_url'] = f'/api/ticket/{item["id"]}'
+                item['ticket_thumb_url'] = f'/api/ticket/{item["id"]}?size=thumb'
         
         return jsonify({'feedback': feedback})
     
@@ -360,8 +1002,41 @@ def get_feedback():
 def get_ticket(feedback_id):
     """Get ticket file for feedback"""
     try:
+        size = request.args.get('size', 'original')
+        if size not in ['original', 'thumb']:
+            return jsonify({'error': 'Invalid size'}), 400
+        
         with get_db() as conn:
             cursor = conn.cursor()
+            
+            if size == 'thumb':
+                # Prefer WebP only when the client names it explicitly; */* and
+                # image/* are sent by browsers that cannot decode it
+                variants = ['thumb_jpeg']
+                if any(value == 'image/webp' and quality > 0
+                       for value, quality in request.accept_mimetypes):
+                    variants.insert(0, 'thumb_webp')
+                
+                for variant in variants:
+                    cursor.execute('''
+                        SELECT tf.filename, tv.file_type, tv.file_data
+                        FROM ticket_files tf
+                        JOIN ticket_variants tv ON tv.ticket_file_id = tf.id
+                        WHERE tf.feedback_id = ? AND tv.variant = ?
+                    ''', (feedback_id, variant))
+                    
+                    result = cursor.fetchone()
+                    if result:
+                        response = send_file(
+                            io.BytesIO(result['file_data']),
+                            mimetype=result['file_type'],
+                            as_attachment=False,
+                            download_name=f"thumb_{result['filename']}"
+                        )
+                        response.vary.add('Accept')
+                        return response
+                # Not processed yet (or not an image): fall back to the original
+            
             cursor.execute('''
                 SELECT tf.filename, tf.file_type, tf.file_data, tf.file_size
                 FROM ticket_files tf
@@ -388,7 +1063,7 @@ def get_ticket(feedback_id):
 def get_stats():
     """Get dashboard statistics"""
     try:
-        with get_db() as conn:
+        with get_read_db() as conn:
             cursor = conn.cursor()
             
             # Total feedback
@@ -400,11 +1075,11 @@ def get_stats():
             avg_rating = cursor.fetchone()['avg_rating'] or 0
             
             # Active issues
-            cursor.execute('SELECT COUNT(*) as active FROM feedback WHERE status = "new"')
+            cursor.execute("SELECT COUNT(*) as active FROM feedback WHERE status = 'new'")
             active_issues = cursor.fetchone()['active']
             
             # Resolved issues
-            cursor.execute('SELECT COUNT(*) as resolved FROM feedback WHERE status = "resolved"')
+            cursor.execute("SELECT COUNT(*) as resolved FROM feedback WHERE status = 'resolved'")
             resolved_issues = cursor.fetchone()['resolved']
             
             # Problem distribution
@@ -514,41 +1189,109 @@ def update_feedback_status(feedback_id):
 
 @app.route('/api/analytics/routes', methods=['GET'])
 def get_route_analytics():
-    """Get analytics for specific routes"""
+    """Get route analytics from the rollup tables, optionally as a time series"""
     try:
-        with get_db() as conn:
+        bucket = request.args.get('bucket')
+        if bucket and bucket not in ROLLUP_BUCKETS:
+            return jsonify({'error': f'Invalid bucket: {bucket}'}), 400
+        
+        try:
+            hours = parse_hours(request.args['hours']) if request.args.get('hours') else None
+            range_to = datetime.fromisoformat(request.args['to']) if request.args.get('to') else None
+            range_from = datetime.fromisoformat(request.args['from']) if request.args.get('from') else None
+            limit = int(request.args.get('limit', 10))
+            
+            # Hour-of-day windows can only be answered from hourly rollups
+            preferred = 'hour' if hours else (bucket or 'week')
+            
+            # Time series need a bounded range; the open end runs to the end of the current bucket
+            if bucket:
+                range_to = range_to or next_bucket_boundary(datetime.now(), preferred)
+                range_from = range_from or range_to - DEFAULT_RANGES[bucket]
+            
+            # Never widen the range: fall back to finer rollups for unaligned bounds
+            source = rollup_source(preferred, range_from, range_to)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        filters = {
+            'hours': hours,
+            'route': request.args.get('route'),
+            'transport_type': request.args.get('transport_type')
+        }
+        
+        with get_read_db() as conn:
             cursor = conn.cursor()
             
-            # Top problematic routes
-            cursor.execute('''
-                SELECT route, transport_type, 
-                       COUNT(*) as complaint_count,
-                       AVG(CAST(rating as FLOAT)) as avg_rating,
-                       GROUP_CONCAT(DISTINCT problems) as common_problems
-                FROM feedback 
-                WHERE rating <= 3
-                GROUP BY route, transport_type
-                ORDER BY complaint_count DESC, avg_rating ASC
-                LIMIT 10
-            ''')
+            # Totals (and series points) per route over the whole range
+            totals = {}
+            series = {}
+            for row in fetch_route_rollups(cursor, source, range_from, range_to, **filters):
+                key = (row['route'], row['transport_type'])
+                add_rollup_row(totals.setdefault(key, empty_rollup_totals()), row)
+                if bucket:
+                    point = bucket_start(datetime.fromisoformat(row['bucket_start']), bucket)
+                    add_rollup_row(series.setdefault(key, {}).setdefault(point, empty_rollup_totals()), row)
             
-            problematic_routes = []
-            for row in cursor.fetchall():
-                problems_set = set()
-                if row['common_problems']:
-                    for problems in row['common_problems'].split(','):
-                        if problems:
-                            problems_set.update(problems.split(','))
+            problems = fetch_route_problems(cursor, source, range_from, range_to, **filters)
+        
+            problematic = sorted(
+                (key for key, t in totals.items() if t['complaint_count']),
+                key=lambda key: (-totals[key]['complaint_count'],
+                                 totals[key]['complaint_rating_sum'] / totals[key]['complaint_count'])
+            )
+            problematic_routes = [{
+                'route': key[0],
+                'transport_type': key[1],
+                'complaint_count': totals[key]['complaint_count'],
+                'avg_rating': round(totals[key]['complaint_rating_sum'] / totals[key]['complaint_count'], 1),
+                'common_problems': top_route_problems(problems.get(key, []), 'complaint_count')
+            } for key in problematic[:limit]]
+            
+            response = {'problematic_routes': problematic_routes}
+            
+            # Echo the effective range
+            if range_from or range_to:
+                response.update({
+                    'from': range_from.isoformat() if range_from else None,
+                    'to': range_to.isoformat() if range_to else None,
+                    'granularity': source
+                })
+            
+            if bucket:
+                # Trailing 7x24h ending at `to` against the 7x24h before; `to` is
+                # aligned to the source rollup, so both windows are exact
+                wow_source = 'day' if not hours and is_bucket_aligned(range_to, 'day') else 'hour'
+                this_week_start = bucket_start(range_to - timedelta(days=7), wow_source)
+                weeks = {}
+                for row in fetch_route_rollups(cursor, wow_source, range_to - timedelta(days=14),
+                                               range_to, **filters):
+                    key = (row['route'], row['transport_type'])
+                    pair = weeks.setdefault(key, (empty_rollup_totals(), empty_rollup_totals()))
+                    add_rollup_row(pair[0] if row['bucket_start'] >= this_week_start else pair[1], row)
+                
+                routes = []
+                busiest = sorted(totals, key=lambda key: -totals[key]['feedback_count'])
+                for key in busiest[:limit]:
+                    this_week, last_week = weeks.get(key, (empty_rollup_totals(), empty_rollup_totals()))
+                    routes.append({
+                        'route': key[0],
+                        'transport_type': key[1],
+                        'summary': dict(describe_rollup_totals(totals[key]),
+                                        top_problems=top_route_problems(problems.get(key, []), 'problem_count')),
+                        'series': [dict(describe_rollup_totals(point_totals), bucket_start=point)
+                                   for point, point_totals in sorted(series[key].items())],
+                        'week_over_week': week_over_week(describe_rollup_totals(this_week),
+                                                         describe_rollup_totals(last_week))
+                    })
                 
-                problematic_routes.append({
-                    'route': row['route'],
-                    'transport_type': row['transport_type'],
-                    'complaint_count': row['complaint_count'],
-                    'avg_rating': round(row['avg_rating'], 1),
-                    'common_problems': list(problems_set)[:3]  # Top 3 problems
+                response.update({
+                    'bucket': bucket,
+                    'hours': list(hours) if hours else None,
+                    'routes': routes
                 })
         
-        return jsonify({'problematic_routes': problematic_routes})
+        return jsonify(response)
     
     except Exception as e:
         logger.error(f"Error getting route analytics: {e}")
@@ -603,7 +1346,7 @@ def export_csv():
         import csv
         from io import StringIO
         
-        with get_db() as conn:
+        with get_read_db() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM feedback ORDER BY timestamp DESC')
             feedback = cursor.fetchall()
@@ -644,7 +1387,7 @@ def export_csv():
 def get_file_stats():
     """Get file upload statistics"""
     try:
-        with get_db() as conn:
+        with get_read_db() as conn:
             cursor = conn.cursor()
             
             # Total files
@@ -672,12 +1415,38 @@ def get_file_stats():
                 LIMIT 10
             ''')
             recent_uploads = [dict(row) for row in cursor.fetchall()]
+            
+            # Image compression savings
+            cursor.execute('''
+                SELECT COUNT(*) as processed_files,
+                       SUM(original_size) as original_size,
+                       SUM(compressed_size) as compressed_size
+                FROM ticket_processing
+                WHERE status = 'done'
+            ''')
+            row = cursor.fetchone()
+            original_size = row['original_size'] or 0
+            compressed_size = row['compressed_size'] or 0
+            
+            cursor.execute('''
+                SELECT COUNT(*) as thumbnails, SUM(file_size) as thumbnail_size
+                FROM ticket_variants
+            ''')
+            thumbs = cursor.fetchone()
         
         return jsonify({
             'total_files': total_files,
             'total_size': total_size,
             'file_types': file_types,
-            'recent_uploads': recent_uploads
+            'recent_uploads': recent_uploads,
+            'compression': {
+                'processed_files': row['processed_files'],
+                'original_size': original_size,
+                'compressed_size': compressed_size,
+                'bytes_saved': original_size - compressed_size,
+                'thumbnails': thumbs['thumbnails'],
+                'thumbnail_size': thumbs['thumbnail_size'] or 0
+            }
         })
     
     except Exception as e:
@@ -703,6 +1472,11 @@ if __name__ == '__main__':
     # Initialize database
     init_db()
     
+    # One-off: thumbnail and recompress tickets uploaded before the pipeline existed
+    if len(sys.argv) > 1 and sys.argv[1] == 'backfill-thumbnails':
+        backfill_ticket_images()
+        sys.exit(0)
+    
     print("=" * 60)
     print("🚀 Smart Transport Feedback API Server Starting...")
     print("=" * 60)
@@ -711,7 +1485,7 @@ if __name__ == '__main__':
     print("📋 Endpoints:")
     print("   POST /api/feedback - Submit feedback (with file upload)")
     print("   GET  /api/feedback - Get all feedback")
-    print("   GET  /api/ticket/<id> - View uploaded ticket")
+    print("   GET  /api/ticket/<id> - View uploaded ticket (?size=thumb)")
     print("   GET  /api/stats - Get statistics")
     print("   GET  /api/hotspots - Get map hotspots")
     print("   PUT  /api/feedback/{id}/status - Update status")